@@ -31,6 +31,7 @@ import io
 import logging
 import serial
 import socket
+import struct
 import termios
 import time
 import typing
@@ -55,15 +56,25 @@ class Arm(enum.Enum):
 
 
 Status = typing.NewType('Status', typing.Dict[str, typing.Any])
-Partitions = typing.NewType('Partitions', typing.Set[int])
-Zones = typing.NewType('Partitions', typing.Set[int])
-Outputs = typing.NewType('Partitions', typing.Set[int])
+Partitions = typing.NewType('Partitions', typing.AbstractSet[int])
+Zones = typing.NewType('Partitions', typing.FrozenSet[int])
+Outputs = typing.NewType('Partitions', typing.FrozenSet[int])
+
+_UINT16_BE = struct.Struct('>H')
+_UINT16_LE = struct.Struct('<H')
 
 
 class Alarm(object):
   """Class wrapping the protocol for PIMA alarm."""
   _ZONES_TO_MODULE_ID = {32: b'\x0d', 96: b'\x0d', 144: b'\x13'}
   _ZONES_TO_ZONE_BYTES = {32: 12, 96: 12, 144: 18}
+  _ARM_NAMES = {mode.value[0]: mode.name.lower() for mode in Arm}
+  _ZONE_GROUPS = ('open zones', 'alarmed zones', 'bypassed zones', 'failed zones')
+  _RX_CHUNK_SIZE = 256
+  # Seconds to wait for input before considering the connection dead.
+  _READ_TIMEOUT = 5
+  # CRC-16/ARC. Built once, as crcmod generates the lookup table on each mkCrcFun call.
+  _crc = staticmethod(crcmod.mkCrcFun(0x18005, rev=True, initCrc=0x0000, xorOut=0x0000))
 
   class _Message(enum.Enum):
     WRITE = b'\x0f'
@@ -131,32 +142,88 @@ class Alarm(object):
       48: 'Unknown (48)',
   }
 
+  # Failures reported per device, as (name format, number of bytes).
+  _CLUSTERED_FAILURES = (
+      ('Keypad %d Failure', 1),
+      ('Keypad %d Tamper', 1),
+      ('Zone Expander %d Failure', 2),
+      ('Zone Expander %d Tamper', 2),
+      ('Zone Expander %d Low Voltage', 2),
+      ('Zone Expander %d AC Failure', 2),
+      ('Zone Expander %d Low Battery', 2),
+      ('Out Expander %d Failure', 1),
+      ('Out Expander %d Tamper', 1),
+      ('Out Expander %d Low Voltage', 1),
+      ('Out Expander %d AC Failure', 1),
+      ('Out Expander %d Low Battery', 1),
+  )
+
   def __init__(self,
                zones: int,
                serialport: str = None,
                ipaddr: str = None,
-               ipport: int = None) -> None:
+               ipport: int = None,
+               pacing_delay: float = 1.0) -> None:
     if serialport is not None:
       try:
         self._channel = serial.Serial(port=serialport,
                                       baudrate=2400,
                                       bytesize=serial.EIGHTBITS,
                                       parity=serial.PARITY_NONE,
-                                      timeout=1)
+                                      timeout=self._READ_TIMEOUT)
       except (termios.error, serial.serialutil.SerialException) as e:
         self._channel = None
         raise Error('Failed to connect to serial port.') from e
     else:
       try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self._READ_TIMEOUT)
         sock.connect((ipaddr, ipport))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Detect a net4pro that went away while the connection was idle.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+          sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+          sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
         self._channel = socket.SocketIO(sock, 'rwb')
       except (socket.error, socket.gaierror) as e:
         self._channel = None
         raise Error('Error creating socket.') from e
-    self._crc = crcmod.mkCrcFun(0x18005, rev=True, initCrc=0x0000, xorOut=0x0000)
     self._zones = zones  # type: int
     self._module_id = self._ZONES_TO_MODULE_ID[self._zones]  # type: bytes
+    # Distance between the zone groups in a status message.
+    self._zone_stride = self._ZONES_TO_ZONE_BYTES[self._zones]  # type: int
+    # HP32 zones us using only the first bytes.
+    self._zone_size = self._zones // 8  # type: int
+    zone_format = '{}s{}x'.format(self._zone_size, self._zone_stride - self._zone_size)
+    # Failure names by their bit index in the failures region of a status message, which holds
+    # 6 bytes of discrete failures followed by the clustered ones.
+    failure_names = [self._DISCRETE_FAILURES[failure] for failure in range(1, 6 * 8 + 1)]
+    for fail_type, count in self._CLUSTERED_FAILURES:
+      failure_names.extend(fail_type % failure for failure in range(1, count * 8 + 1))
+    self._failure_names = tuple(failure_names)  # type: typing.Tuple[str, ...]
+    # The status message after its header: zone groups, partitions, failures, then the ID account
+    # (skipped) and the flags.
+    status_format = '<{}16s{}s4xB'.format(zone_format * len(self._ZONE_GROUPS),
+                                          len(failure_names) // 8)  # type: str
+    self._status_struct = struct.Struct(status_format)  # type: struct.Struct
+    # Seconds to let the alarm process a command before sending the next message.
+    self._pacing_delay = pacing_delay  # type: float
+    # time.monotonic() value before which no message should be sent.
+    self._next_send_time = 0.0  # type: float
+    # The last parsed status message, reused while the alarm keeps reporting the same bytes.
+    self._last_response = None  # type: typing.Optional[bytes]
+    self._last_status = None  # type: typing.Optional[Status]
+    self._status_revision = 0  # type: int
+    # Input read from the channel beyond the current frame.
+    self._rx_buffer = bytearray()  # type: bytearray
+    self._rx_chunk = bytearray(self._RX_CHUNK_SIZE)  # type: bytearray
+    # Outgoing frames are assembled in place, to avoid allocations per message.
+    self._tx_buffer = bytearray(32)  # type: bytearray
+    self._headers = {
+        (message, channel): self._module_id + message.value + channel.value
+        for message in self._Message for channel in self._Channel
+    }  # type: typing.Dict[tuple, bytes]
 
   def __del__(self) -> None:
     self._close()
@@ -173,6 +240,11 @@ class Alarm(object):
     self._send_message(self._Message.WRITE, self._Channel.LOGIN, data=data)
     return self.get_status()
 
+  @property
+  def status_revision(self) -> int:
+    """Changes whenever get_status() returns a status other than the cached one."""
+    return self._status_revision
+
   def get_status(self) -> Status:
     """Returns the current alarm status."""
     try:
@@ -186,56 +258,45 @@ class Alarm(object):
       response = self._read_message()
       self._send_message(self._Message.STATUS, self._Channel.IDLE)
     if not response:
-      return data
+      return self._logged_out(data)
+    if response == self._last_response:
+      return self._copy_status(self._last_status)
     if response[2:3] != self._Message.STATUS.value:
       raise Error('Invalid message {}.'.format(self._make_hex(response[2:3])))
     if response[3:4] == self._Channel.IDLE.value:
-      return data
+      return self._logged_out(data)
     if response[3:4] != self._Channel.SYSTEM.value:
       raise Error('Invalid status {}.'.format(self._make_hex(response[3:4])))
     if response[4:7] != b'\x02\x00\x00':
       raise Error('Invalid address {}.'.format(self._make_hex(response[4:7])))
-    # Calculate the break points.
-    zone_bytes = range(7, len(response), self._ZONES_TO_ZONE_BYTES[self._zones])[:5]
-    # Get the data chuncks.
-    # HP32 zones us using only the first bytes.
-    zone_data = [response[i:i + self._zones // 8] for i in zone_bytes[:-1]]
-    data['open zones'] = self._parse_bytes(zone_data[0])
-    data['alarmed zones'] = self._parse_bytes(zone_data[1])
-    data['bypassed zones'] = self._parse_bytes(zone_data[2])
-    data['failed zones'] = self._parse_bytes(zone_data[3])
-    index = zone_bytes[-1]
-    data['partitions'] = {}
-    for partition, value in enumerate(response[index:index + 16], 1):
-      data['partitions'][partition] = Arm(bytes([value])).name.lower()
-    index += 16
-    failures = self._parse_bytes(response[index:index + 6])
-    failures = {self._DISCRETE_FAILURES[failure] for failure in failures}
-    index += 6
-    for fail_type, count in (('Keypad %d Failure', 1), ('Keypad %d Tamper', 1),
-                             ('Zone Expander %d Failure', 2), ('Zone Expander %d Tamper', 2),
-                             ('Zone Expander %d Low Voltage', 2), ('Zone Expander %d AC Failure',
-                                                                   2),
-                             ('Zone Expander %d Low Battery', 2), ('Out Expander %d Failure', 1),
-                             ('Out Expander %d Tamper', 1), ('Out Expander %d Low Voltage', 1),
-                             ('Out Expander %d AC Failure', 1), ('Out Expander %d Low Battery', 1)):
-      clustered_failures = self._parse_bytes(response[index:index + count])
-      for failure in clustered_failures:
-        failures.add(fail_type % failure)
-      index += count
+    try:
+      fields = self._status_struct.unpack_from(response, 7)
+    except struct.error as e:
+      raise Error('Invalid status length {}.'.format(len(response))) from e
+    for zone_group, zone_data in zip(self._ZONE_GROUPS, fields):
+      data[zone_group] = self._parse_bytes(zone_data)
+    data['partitions'] = {
+        partition: self._ARM_NAMES[value] for partition, value in enumerate(fields[4], 1)
+    }
+    failures = frozenset(
+        self._failure_names[bit] for bit in self._parse_bytes(fields[5], one_based=False))
     if failures:
       data['failures'] = failures
-    # Skip ID Account
-    index += 4
-    flags = response[index]
+    flags = fields[6]
     data['logged in'] = bool(flags & 1 << 0)
     data['command ack'] = bool(flags & 1 << 1)
-    return data
+    self._last_response = response
+    self._last_status = data
+    self._status_revision += 1
+    return self._copy_status(data)
 
   def arm(self, mode: Arm, partitions: Partitions) -> Status:
     """Arms (or disarms) the provided alarm partitions."""
     self._read_message()
-    address = sum(1 << (p - 1) for p in partitions).to_bytes(2, byteorder='little')
+    mask = 0
+    for partition in partitions:
+      mask |= 1 << (partition - 1)
+    address = _UINT16_LE.pack(mask)
     self._send_message(self._Message.OPEN if mode == Arm.DISARM else self._Message.CLOSE,
                        self._Channel.SYSTEM,
                        address=address,
@@ -251,7 +312,7 @@ class Alarm(object):
       response = self._read_message()
       self._send_message(self._Message.STATUS, self._Channel.IDLE)
     if not response:
-      return Outputs()
+      return Outputs(frozenset())
     if response[3:4] != self._Channel.ZONES.value:
       raise Error('Invalid outputs response {}.'.format(self._make_hex(response)))
     if response[4:7] != b'\x02\xff\xff':
@@ -267,7 +328,7 @@ class Alarm(object):
       response = self._read_message()
       self._send_message(self._Message.STATUS, self._Channel.IDLE)
     if not response:
-      return Outputs()
+      return Outputs(frozenset())
     if response[2:3] != b'\x05' and response[3:4] != self._Channel.OUTPUTS.value:
       raise Error('Invalid outputs response {}.'.format(self._make_hex(response)))
     if response[4:7] != b'\x02\x00\x00':
@@ -278,18 +339,23 @@ class Alarm(object):
     raise NotImplementedError("No support yet for parameters.")
 
   def _read_message(self) -> bytes:
-    data = None
-    while not data:
-      data = self._channel.read(1)
-    length = ord(data)
-    data = bytes([length]) + self._channel.read(length + 2)
-    if data == bytes([length]) * len(data):
+    if not self._rx_buffer:
+      self._fill_rx_buffer(1)
+    rx = self._rx_buffer
+    length = rx[0]
+    end = length + 3
+    # Socket reads may return part of the frame, so read until it's complete.
+    while len(rx) < end:
+      self._fill_rx_buffer(end - len(rx))
+    if rx.count(length, 0, end) == end:
+      del rx[:end]
       raise GarbageInputError('Garbage ({})!'.format(length))
-    if len(data) != length + 3:
-      raise Error('Not enough data in channel: {} should have {} bytes.'.format(
-          self._make_hex(data), length + 3))
-    logging.debug('>>> ' + self._make_hex(data))
-    data, crc = data[:-2], int.from_bytes(data[-2:], byteorder='big')
+    with memoryview(rx) as view:
+      if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('>>> %s', self._make_hex(view[:end]))
+      data = bytes(view[:end - 2])
+    (crc,) = _UINT16_BE.unpack_from(rx, end - 2)
+    del rx[:end]
     if (crc != self._crc(data)):
       raise Error('Invalid input on channel, CRC for {} is {}, not {}!'.format(
           self._make_hex(data), self._crc(data), crc))
@@ -298,29 +364,80 @@ class Alarm(object):
                                                                   self._make_hex(data[1:2])))
     return data
 
+  def _fill_rx_buffer(self, size: int) -> None:
+    """Reads the next chunk of input, of at least size bytes if the channel provides them."""
+    if isinstance(self._channel, serial.Serial):
+      # Take everything already pending, without waiting for the read timeout.
+      size = max(size, self._channel.in_waiting)
+    else:
+      # Socket reads return whatever has arrived, up to the requested size.
+      size = self._RX_CHUNK_SIZE
+    with memoryview(self._rx_chunk) as chunk:
+      try:
+        count = self._channel.readinto(chunk[:min(size, self._RX_CHUNK_SIZE)])
+      except socket.timeout as e:
+        raise Error('Timed out reading from channel.') from e
+      if not count:
+        # Serial reads return nothing on timeout, socket reads when the peer closed.
+        raise Error('No data in channel.')
+      self._rx_buffer += chunk[:count]
+
   def _send_message(self,
                     message: _Message,
                     channel: _Channel,
                     address: bytes = b'',
                     data: bytes = b'') -> None:
-    output = b''.join(
-        (self._module_id, message.value, channel.value, bytes([len(address)]), address, data))
-    output = bytes([len(output)]) + output
-    output += self._crc(output).to_bytes(2, byteorder='big')
-    logging.debug('<<< ' + self._make_hex(output))
-    self._channel.write(output)
+    delay = self._next_send_time - time.monotonic()
+    if delay > 0:
+      time.sleep(delay)
+    end = 5 + len(address)
+    if len(self._tx_buffer) < end + len(data) + 2:
+      self._tx_buffer = bytearray(end + len(data) + 2)
+    buffer = self._tx_buffer
+    buffer[1:4] = self._headers[message, channel]
+    buffer[4] = len(address)
+    buffer[5:end] = address
+    buffer[end:end + len(data)] = data
+    end += len(data)
+    buffer[0] = end - 1
+    with memoryview(buffer) as view:
+      _UINT16_BE.pack_into(buffer, end, self._crc(view[:end]))
+      output = view[:end + 2]
+      if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('<<< %s', self._make_hex(output))
+      self._channel.write(output)
     if message != self._Message.STATUS:
-      time.sleep(1)
+      # Only delay the next send, so reading the alarm's response can proceed meanwhile.
+      self._next_send_time = time.monotonic() + self._pacing_delay
+
+  def _logged_out(self, status: Status) -> Status:
+    # Parse the next status message anew, as it follows a different status.
+    self._last_response = None
+    self._status_revision += 1
+    return status
+
+  @staticmethod
+  def _copy_status(status: Status) -> Status:
+    # The zone groups and failures are frozen, so only the dictionaries are copied.
+    return Status(dict(status, partitions=dict(status['partitions'])))
 
   @staticmethod
-  def _parse_bytes(data: bytes, one_based: bool = True) -> typing.Set[int]:
+  def _parse_bytes(data: typing.Union[bytes, memoryview],
+                   one_based: bool = True) -> typing.FrozenSet[int]:
     bits = int.from_bytes(data, byteorder='little')
-    base = 1 if one_based else 0
-    return {i + base for i in range(bits.bit_length()) if bits & 1 << i}
+    # bit_length() of a single bit is its one-based index.
+    base = 0 if one_based else -1
+    result = []  # type: typing.List[int]
+    # Visit only the set bits, by isolating and clearing the lowest one each time.
+    while bits:
+      lowest = bits & -bits
+      result.append(lowest.bit_length() + base)
+      bits ^= lowest
+    return frozenset(result)
 
   @staticmethod
-  def _make_hex(data: bytes) -> str:
-    return ' '.join('%02x' % d for d in data)
+  def _make_hex(data: typing.Union[bytes, memoryview]) -> str:
+    return data.hex(' ')
 
   def _close(self) -> None:
     if self._channel:
@@ -26,13 +26,23 @@ __author__ = 'droreiger@gmail.com (Dror Eiger)'
 __version__ = '0.7.2.10'
 
 import argparse
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import atexit
+import concurrent.futures
+import functools
+import hmac
+import io
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
 import logging
 import logging.handlers
-import re
 import os
+try:
+  import orjson
+except ImportError:
+  orjson = None
 import paho.mqtt.client as mqtt
+import queue
+import random
 import socket
 import ssl
 import sys
@@ -42,8 +52,9 @@ except:
   JournalHandler = None
 import threading
 import time
+import types
 import typing
-from urllib.parse import parse_qs, urlparse, ParseResult
+from urllib.parse import parse_qs
 import _thread
 
 import pima
@@ -53,6 +64,11 @@ class AlarmServer(threading.Thread):
   """Class maintaining the current status and sends commands to the alarm."""
 
   _SERIAL_BASE = '/dev/serial/by-path'
+  # Seconds between status polls, backing off while the status does not change.
+  _MIN_POLL_INTERVAL = 1.0
+  _MAX_POLL_INTERVAL = 5.0
+  # Seconds to wait for a queued arm command to complete.
+  _ARM_TIMEOUT = 30.0
 
   def __init__(self) -> None:
     self._alarm: pima.Alarm = None
@@ -80,16 +96,23 @@ class AlarmServer(threading.Thread):
         sys.exit(1)
       serialport = os.path.join(self._SERIAL_BASE, ports[0])
       logging.debug('Port: %s.', serialport)
-    self._alarm_args = _parsed_args.zones, serialport, ipaddr, ipport  # type: tuple
+    pacing_delay = _parsed_args.pacing_delay  # type: float
+    self._alarm_args = _parsed_args.zones, serialport, ipaddr, ipport, pacing_delay  # type: tuple
+    # The last status and outputs read from the alarm.
+    self._status = None  # type: typing.Optional[pima.Status]
+    self._status_revision = None  # type: typing.Optional[int]
+    self._outputs = None  # type: typing.Optional[pima.Outputs]
+    # The status with its outputs, and its JSON encoding. Replaced as a whole by the server thread,
+    # so readers get a consistent pair without locking.
+    self._snapshot = (None, to_json(None))  # type: typing.Tuple[pima.Status, bytes]
     try:
       self._create_alarm()
     except pima.Error:
       logging.exception('Failed to create alarm object.')
       sys.exit(1)
-    self._status_lock = threading.Lock()
-    self._status = None
-    self._outputs = None
-    self._alarm_lock = threading.Lock()
+    # Commands for the alarm, run by the server thread, which owns the alarm connection.
+    self._commands = queue.Queue()  # type: queue.Queue
+    self._poll_interval = self._MIN_POLL_INTERVAL  # type: float
     super(AlarmServer, self).__init__(name='PIMA Alarm Server')
 
   def __del__(self) -> None:
@@ -97,116 +120,190 @@ class AlarmServer(threading.Thread):
       del self._alarm
 
   def run(self) -> None:
-    """Continuously query the alarm for status."""
+    """Continuously query the alarm for status, running queued commands in between."""
     while True:
       try:
-        with self._alarm_lock:
-          status = self._alarm.get_status()  # type: pima.Status
-          while not status['logged in']:
-            # Re-login if previous session ended.
-            status = self._alarm.login(_parsed_args.login)
-          try:
-            outputs = self._alarm.get_outputs()  # type: pima.Outputs
-          except pima.Error as e:
-            logging.debug('Failed to get outputs status: %r', e)
-            outputs = None
-          self._set_status(status, outputs)
-        time.sleep(1)
+        try:
+          command = self._commands.get(timeout=self._poll_interval)
+        except queue.Empty:
+          command = None
+        if command:
+          self._poll_interval = self._MIN_POLL_INTERVAL
+          self._run_arm(*command)
+        else:
+          self._poll_status()
       except:
         logging.exception('Exception raised by Alarm.')
         try:
-          with self._alarm_lock:
-            logging.info('Trying to create the Alarm anew.')
-            self._create_alarm()
+          logging.info('Trying to create the Alarm anew.')
+          self._create_alarm()
         except pima.Error:
           logging.exception('Failed to recreate Alarm object. Exit for a clean restart.')
           _thread.interrupt_main()
 
   def get_status(self) -> pima.Status:
     """Gets the internally stored alarm status."""
-    with self._status_lock:
-      return self._status
+    return self._snapshot[0]
+
+  def get_status_json(self) -> bytes:
+    """Gets the internally stored alarm status, encoded as JSON."""
+    return self._snapshot[1]
 
   def arm(self, mode: pima.Arm, partitions: pima.Partitions) -> pima.Status:
     """Arms (or disarms) the alarm, returning the status."""
-    with self._alarm_lock:
-      status = self._alarm.arm(mode, partitions)  # type: pima.Status
-      self._set_status(status)
-      return status
-
-  def _set_status(self, status: pima.Status, outputs: typing.Optional[pima.Outputs] = None) -> None:
-    with self._status_lock:
-      if self._status == status and (outputs is None or self._outputs == outputs):
-        return  # No update, ignore.
-      self._status = status.copy()
-      # If did not get outputs status, retain the existing one.
-      if outputs is None and self._outputs is not None:
-        outputs = self._outputs
+    result = concurrent.futures.Future()  # type: concurrent.futures.Future
+    self._commands.put((mode, partitions, result))
+    try:
+      return result.result(timeout=self._ARM_TIMEOUT)
+    except concurrent.futures.TimeoutError:
+      # Don't arm later if the command is still queued.
+      result.cancel()
+      raise
+
+  def _poll_status(self) -> None:
+    status = self._alarm.get_status()  # type: pima.Status
+    while not status['logged in']:
+      # Re-login if previous session ended.
+      status = self._alarm.login(_parsed_args.login)
+    try:
+      outputs = self._alarm.get_outputs()  # type: pima.Outputs
+    except pima.Error as e:
+      logging.debug('Failed to get outputs status: %r', e)
+      outputs = None
+    if self._set_status(status, outputs):
+      self._poll_interval = self._MIN_POLL_INTERVAL
+    else:
+      self._poll_interval = min(self._poll_interval * 2, self._MAX_POLL_INTERVAL)
+
+  def _run_arm(self, mode: pima.Arm, partitions: pima.Partitions,
+               result: concurrent.futures.Future) -> None:
+    if not result.set_running_or_notify_cancel():
+      return  # The caller timed out.
+    try:
+      self._set_status(self._alarm.arm(mode, partitions))
+    except pima.Error as e:
+      # Let run() recreate the alarm connection.
+      result.set_exception(e)
+      raise
+    except Exception as e:
+      result.set_exception(e)
+      return
+    result.set_result(self.get_status())
+
+  def _set_status(self, status: pima.Status, outputs: typing.Optional[pima.Outputs] = None) -> bool:
+    """Stores and publishes the status, returning whether it changed."""
+    # Only compare the statuses when the alarm parsed a new one, which is rare.
+    revision = self._alarm.status_revision  # type: int
+    status_changed = False
+    if revision != self._status_revision:
+      self._status_revision = revision
+      status_changed = self._status != status
+    if not status_changed and (outputs is None or self._outputs == outputs):
+      return False  # No update, ignore.
+    self._status = status
+    # If did not get outputs status, retain the existing one.
+    if outputs is not None:
       self._outputs = outputs
-      # Don't pass None to MQTT.
-      if outputs is None:
-        outputs = pima.Outputs()
-    status['outputs'] = outputs
-    logging.info('Status: %s.', status)
-    mqtt_publish_status(status)
+    # Don't pass None to MQTT.
+    status = pima.Status(dict(status, outputs=self._outputs or pima.Outputs(frozenset())))
+    status_json = to_json(status)
+    self._snapshot = (status, status_json)
+    if logging.root.isEnabledFor(logging.INFO):
+      # Logged as JSON, which lists the frozen sets plainly.
+      logging.info('Status: %s.', status_json.decode('utf-8'))
+    mqtt_publish_status(status_json)
+    return True
 
   def _create_alarm(self) -> None:
     self._alarm = pima.Alarm(*self._alarm_args)  # type: pima.Alarm
-    self._status = self._alarm.get_status()  # type: pima.Status
-    logging.info('Status: %s.', self._status)
-    while not self._status['logged in']:
-      self._status = self._alarm.login(_parsed_args.login)
-      logging.info('Status: %s.', self._status)
+    status = self._alarm.get_status()  # type: pima.Status
+    while not status['logged in']:
+      logging.info('Status: %s.', to_json(status).decode('utf-8'))
+      status = self._alarm.login(_parsed_args.login)
+    # The revisions of a new alarm object start over.
+    self._status_revision = None
+    self._set_status(status)
 
 
-def RunJsonCommand(query: dict) -> dict:
-  _CMD_STATUS = 'status'
-  _CMD_ARM = 'arm'
-  if not _pima_server:
-    return {'error': 'No server.'}
+def _RunStatusCommand(query: dict) -> bytes:
+  return _pima_server.get_status_json()
+
+
+_DEFAULT_PARTITIONS = pima.Partitions(frozenset({1}))
+_VALID_PARTITIONS = frozenset(range(1, 17))
+
+
+def _RunArmCommand(query: dict) -> bytes:
   try:
-    command = query['command']
+    mode = query['mode']
+    if isinstance(mode, (list, tuple)):
+      mode = mode[0]
+    mode = pima.Arm[mode.upper()]
   except KeyError:
-    return {'error': 'Missing command.'}
-  if isinstance(command, list):
-    command = command[0]
-  if command == _CMD_STATUS:
-    return _pima_server.get_status()
-  if command == _CMD_ARM:
+    return to_json({'error': 'Invalid arm mode.'})
+  if 'partitions' in query:
     try:
-      mode = query['mode']
-      if isinstance(mode, list):
-        mode = mode[0]
-      mode = pima.Arm[mode.upper()]
-    except KeyError:
-      return {'error': 'Invalid arm mode.'}
-    partitions = pima.Partitions({int(p) for p in query.get('partitions', ['1'])})
-    return _pima_server.arm(mode, partitions)
-  return {'error': 'Invalid command.'}
+      partitions = pima.Partitions({int(p) for p in query['partitions']})
+    except (TypeError, ValueError):
+      return to_json({'error': 'Invalid partitions.'})
+    if not partitions <= _VALID_PARTITIONS:
+      return to_json({'error': 'Invalid partitions.'})
+  else:
+    partitions = _DEFAULT_PARTITIONS
+  return to_json(_pima_server.arm(mode, partitions))
 
 
-class JsonEncoder(json.JSONEncoder):
-  """Class for JSON encoding."""
+_COMMANDS = {
+    'status': _RunStatusCommand,
+    'arm': _RunArmCommand,
+}  # type: typing.Dict[str, typing.Callable[[dict], bytes]]
 
-  def default(self, obj):
-    if isinstance(obj, set):
-      return list(obj)
-    return json.JSONEncoder.default(self, obj)
+
+def RunJsonCommand(query: dict) -> bytes:
+  """Runs the command in the provided query, returning the JSON encoded result."""
+  if not _pima_server:
+    return to_json({'error': 'No server.'})
+  try:
+    command = query['command']
+  except KeyError:
+    return to_json({'error': 'Missing command.'})
+  if isinstance(command, (list, tuple)):
+    command = command[0]
+  try:
+    run_command = _COMMANDS[command]
+  except (KeyError, TypeError):
+    return to_json({'error': 'Invalid command.'})
+  return run_command(query)
 
 
 def to_json(data: dict) -> bytes:
   """Encode the provided dictionary as JSON."""
-  return bytes(json.dumps(data, cls=JsonEncoder), 'utf-8')
+  # Sets are encoded as sorted lists, so equal statuses are always encoded the same.
+  if orjson:
+    return orjson.dumps(data, default=sorted, option=orjson.OPT_NON_STR_KEYS)
+  return json.dumps(data, default=sorted, separators=(',', ':')).encode('utf-8')
 
 
 def from_json(data: bytes) -> dict:
-  """Encode the provided dictionary as JSON."""
-  return json.loads(data.decode('utf-8'))
+  """Decode the provided JSON data."""
+  if orjson:
+    return orjson.loads(data)
+  return json.loads(data)
 
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
   """Handler for PIMA alarm http requests."""
   _PIMA_URL = '/pima'
+  # Keep connections open between requests, so polling clients don't reconnect (and redo the TLS
+  # handshake) every time. Every response has a Content-Length.
+  protocol_version = 'HTTP/1.1'
+  # Seconds before closing an idle connection.
+  timeout = 15
+  disable_nagle_algorithm = True
+  # Buffer the output, so the header and body go out together when the request is done.
+  wbufsize = io.DEFAULT_BUFFER_SIZE
+  # Seconds for clients to wait before retrying, while the server is unavailable or restarting.
+  _RETRY_AFTER = 5
 
   def do_HEAD(self) -> None:
     """Return a JSON header."""
@@ -216,51 +313,104 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
   def do_GET(self) -> None:
     """Vaildate and run the request."""
-    self.do_HEAD()
     logging.debug('Request: %s', self.path)
-    parsed_url = urlparse(self.path)
-    query = parse_qs(parsed_url.query)
-    if not self.is_valid_url(parsed_url.path, query) or not _pima_server:
-      self.write_json({'error': 'Invalid URL.'})
+    # Reject other paths up front, so they don't take up room in the parsing cache.
+    query = ParseRequestPath(self.path) if self.path.startswith(self._PIMA_URL) else None
+    if query is None:
+      self.write_json(to_json({'error': 'Invalid URL.'}))
+      return
+    if not _pima_server:
+      self.write_json(to_json({'error': 'No server.'}), code=503)
       return
     try:
       self.write_json(RunJsonCommand(query))
+    except concurrent.futures.TimeoutError:
+      # The alarm is busy, e.g. reconnecting, which doesn't call for a restart.
+      logging.warning('Timed out waiting for the alarm.')
+      self.write_json(to_json({'error': 'Timed out waiting for the alarm.'}), code=503)
     except pima.Error:
       logging.exception('Failed to run command.')
-      self.write_json({'error': 'Failed to run command.'})
-      sys.exit(1)
+      self.write_json(to_json({'error': 'Failed to run command.'}), code=503)
+      # Requests are handled in worker threads, so interrupt the main thread to stop the server.
+      _thread.interrupt_main()
 
-  def write_json(self, data: dict) -> None:
-    """Send out the provided data dict as JSON."""
+  def write_json(self, data: bytes, code: int = 200) -> None:
+    """Send out the provided JSON encoded data, with its header."""
     logging.debug('Response: %r', data)
-    self.wfile.write(to_json(data))
+    self.send_response(code)
+    if code == 503:
+      self.send_header('Retry-After', str(self._RETRY_AFTER))
+    self.send_header('Content-type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
 
   @classmethod
   def is_valid_url(cls, path: str, query: dict) -> bool:
     """Validate the provided URL."""
     if path != cls._PIMA_URL:
       return False
-    if query.get('key', [''])[0] != _parsed_args.key:
-      return False
-    return True
+    key = query.get('key')
+    # Compare in constant time, so the key can't be guessed from response timing.
+    return key is not None and hmac.compare_digest(key[0].encode('utf-8'), _key_bytes)
+
+
+# Clients poll the same few paths, so keep their parsed queries.
+@functools.lru_cache(maxsize=64)
+def ParseRequestPath(path: str) -> typing.Optional[typing.Mapping[str, typing.Tuple[str, ...]]]:
+  """Parses and validates a request path, returning its read-only query, or None if invalid."""
+  # The request path has no scheme, host or fragment, so only split off the query.
+  path, _, query_string = path.partition('?')
+  query = {}  # type: typing.Dict[str, typing.Tuple[str, ...]]
+  if path == HTTPRequestHandler._PIMA_URL:
+    query = {k: tuple(v) for k, v in parse_qs(query_string).items()}
+  if not HTTPRequestHandler.is_valid_url(path, query):
+    return None
+  return types.MappingProxyType(query)
 
 
 def mqtt_on_connect(client: mqtt.Client, userdata, flags, rc):
+  global _mqtt_published_status
   logging.debug('Connected to MQTT at %s:%d', _parsed_args.mqtt_host, _parsed_args.mqtt_port)
 
+  client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+  with _mqtt_publish_lock:
+    # The broker may have lost the retained status while disconnected.
+    _mqtt_published_status = None
+
   mqtt_publish_discovery()
   mqtt_publish_lwt_online()
+  if _pima_server and _pima_server.get_status() is not None:
+    mqtt_publish_status(_pima_server.get_status_json())
 
   client.subscribe(_mqtt_topics['sub'])
 
   logging.debug('Completed registration to MQTT')
 
 
+# Commands are run off the paho network thread, so that a slow alarm does not stall keepalives.
+_mqtt_commands = queue.Queue(maxsize=8)  # type: queue.Queue
+
+
 def mqtt_on_message(client: mqtt.Client, userdata, message: mqtt.MQTTMessage):
   try:
-    mqtt_publish_status(RunJsonCommand(from_json(message.payload)))
-  except pima.Error:
-    logging.exception('Failed handling MQTT message')
+    _mqtt_commands.put_nowait(message.payload)
+  except queue.Full:
+    logging.warning('Too many pending MQTT commands, dropping %r', message.payload)
+
+
+def mqtt_process_commands() -> None:
+  while True:
+    payload = _mqtt_commands.get()
+    try:
+      response = RunJsonCommand(from_json(payload))
+      logging.debug('MQTT command response: %r', response)
+      # Publish the full status, as the response may be an error or lack the outputs.
+      if _pima_server:
+        mqtt_publish_status(_pima_server.get_status_json())
+    except Exception:
+      logging.exception('Failed handling MQTT message')
 
 
 def mqtt_on_disconnect(client: mqtt.Client, userdata, rc):
@@ -268,105 +418,148 @@ def mqtt_on_disconnect(client: mqtt.Client, userdata, rc):
   mqtt_connect()
 
 
-def mqtt_publish_status(status: dict) -> None:
-  if _mqtt_client:
-    _mqtt_client.publish(_mqtt_topics['pub'], payload=to_json(status), retain=True)
+# Status updates arriving within this many seconds are published once, with the latest payload.
+_MQTT_PUBLISH_DELAY = 0.05
+_mqtt_publish_lock = threading.Lock()
+_mqtt_pending_status = None  # type: typing.Optional[bytes]
+# The last status published in this MQTT session, which the broker retains.
+_mqtt_published_status = None  # type: typing.Optional[bytes]
 
 
-def mqtt_publish_discovery() -> None:
-  if _mqtt_client:
-    device_info = {
-        'identifiers': [f'pima_alarm'],
-        'manufacturer': f'PIMA',
-        'model': f'Hunter Pro 8{_parsed_args.zones}',
-        'name': 'PIMA Alarm',
+def mqtt_publish_status(payload: bytes) -> None:
+  global _mqtt_pending_status
+  if not _mqtt_client:
+    return
+  with _mqtt_publish_lock:
+    flush_scheduled = _mqtt_pending_status is not None
+    _mqtt_pending_status = payload
+  if not flush_scheduled:
+    timer = threading.Timer(_MQTT_PUBLISH_DELAY, mqtt_flush_status)
+    timer.daemon = True
+    timer.start()
+
+
+def mqtt_flush_status() -> None:
+  global _mqtt_pending_status, _mqtt_published_status
+  with _mqtt_publish_lock:
+    payload, _mqtt_pending_status = _mqtt_pending_status, None
+    if payload == _mqtt_published_status:
+      return  # Already retained by the broker.
+    # Published under the lock, so that flushes go out in order.
+    info = _mqtt_client.publish(_mqtt_topics['pub'],
+                                payload=payload,
+                                qos=_parsed_args.mqtt_qos,
+                                retain=True)  # type: mqtt.MQTTMessageInfo
+    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+      _mqtt_published_status = payload
+    else:
+      logging.debug('Failed to publish status: %d', info.rc)
+
+
+# The payloads only depend on the arguments, so they are built and encoded once.
+@functools.lru_cache(maxsize=None)
+def mqtt_discovery_payloads() -> typing.Tuple[typing.Tuple[str, bytes], ...]:
+  """Returns the HomeAssistant discovery topics and their JSON payloads."""
+  payloads = []  # type: typing.List[typing.Tuple[str, bytes]]
+  device_info = {
+      'identifiers': [f'pima_alarm'],
+      'manufacturer': f'PIMA',
+      'model': f'Hunter Pro 8{_parsed_args.zones}',
+      'name': 'PIMA Alarm',
+  }
+  alarm_config = {
+      'name':
+          None,
+      'unique_id':
+          'pima_alarm',
+      'device':
+          device_info,
+      'state_topic':
+          _mqtt_topics['pub'],
+      'command_topic':
+          _mqtt_topics['sub'],
+      'availability_topic':
+          _mqtt_topics['lwt'],
+      'code_arm_required':
+          False,
+      'code_disarm_required':
+          False,
+      'value_template':
+          """{% if 0 in value_json['outputs'] or 1 in value_json['outputs'] %}triggered{%
+                              elif value_json['partitions']['1'] == 'home1' %}armed_home{%
+                              elif value_json['partitions']['1'] == 'home2' %}armed_night{%
+                              elif value_json['partitions']['1'] == 'full_arm' %}armed_away{%
+                              else %}disarmed{% endif %}""",
+      'payload_disarm':
+          '{"command": "arm", "mode": "disarm"}',
+      'payload_arm_home':
+          '{"command": "arm", "mode": "home1"}',
+      'payload_arm_night':
+          '{"command": "arm", "mode": "home2"}',
+      'payload_arm_away':
+          '{"command": "arm", "mode": "full_arm"}'
+  }
+  payloads.append((_mqtt_topics['discovery'].format('alarm_control_panel'), to_json(alarm_config)))
+  for i in range(1, min(_parsed_args.mqtt_discovery_max_zone, _parsed_args.zones) + 1):
+    open_zones_config = {
+        'name':
+            f'Alarm Zone {i} Open',
+        'unique_id':
+            f'pima_alarm_zone_{i}_open',
+        'device': {
+            **device_info, 'via_device': 'pima_alarm'
+        },
+        'state_topic':
+            _mqtt_topics['pub'],
+        'availability_topic':
+            _mqtt_topics['lwt'],
+        'payload_on':
+            'on',
+        'payload_off':
+            'off',
+        'value_template':
+            f"{{% if {i} in value_json['open zones'] %}}on{{% else %}}off{{% endif %}}"
     }
-    alarm_config = {
+    alarmed_zones_config = {
         'name':
-            None,
+            f'Alarm Zone {i} Alarming',
         'unique_id':
-            'pima_alarm',
-        'device':
-            device_info,
+            f'pima_alarm_zone_{i}_alarming',
+        'device': {
+            **device_info, 'via_device': 'pima_alarm'
+        },
         'state_topic':
             _mqtt_topics['pub'],
-        'command_topic':
-            _mqtt_topics['sub'],
         'availability_topic':
             _mqtt_topics['lwt'],
-        'code_arm_required':
-            False,
-        'code_disarm_required':
-            False,
+        'payload_on':
+            'on',
+        'payload_off':
+            'off',
         'value_template':
-            """{% if 0 in value_json['outputs'] or 1 in value_json['outputs'] %}triggered{%
-                              elif value_json['partitions']['1'] == 'home1' %}armed_home{%
-                              elif value_json['partitions']['1'] == 'home2' %}armed_night{%
-                              elif value_json['partitions']['1'] == 'full_arm' %}armed_away{%
-                              else %}disarmed{% endif %}""",
-        'payload_disarm':
-            '{"command": "arm", "mode": "disarm"}',
-        'payload_arm_home':
-            '{"command": "arm", "mode": "home1"}',
-        'payload_arm_night':
-            '{"command": "arm", "mode": "home2"}',
-        'payload_arm_away':
-            '{"command": "arm", "mode": "full_arm"}'
+            f"{{% if {i} in value_json['alarmed zones'] %}}on{{% else %}}off{{% endif %}}"
     }
-    _mqtt_client.publish(_mqtt_topics['discovery'].format('alarm_control_panel'),
-                         payload=to_json(alarm_config),
-                         retain=True)
-    for i in range(1, min(_parsed_args.mqtt_discovery_max_zone, _parsed_args.zones) + 1):
-      open_zones_config = {
-          'name':
-              f'Alarm Zone {i} Open',
-          'unique_id':
-              f'pima_alarm_zone_{i}_open',
-          'device': {
-              **device_info, 'via_device': 'pima_alarm'
-          },
-          'state_topic':
-              _mqtt_topics['pub'],
-          'availability_topic':
-              _mqtt_topics['lwt'],
-          'payload_on':
-              'on',
-          'payload_off':
-              'off',
-          'value_template':
-              f"{{% if {i} in value_json['open zones'] %}}on{{% else %}}off{{% endif %}}"
-      }
-      alarmed_zones_config = {
-          'name':
-              f'Alarm Zone {i} Alarming',
-          'unique_id':
-              f'pima_alarm_zone_{i}_alarming',
-          'device': {
-              **device_info, 'via_device': 'pima_alarm'
-          },
-          'state_topic':
-              _mqtt_topics['pub'],
-          'availability_topic':
-              _mqtt_topics['lwt'],
-          'payload_on':
-              'on',
-          'payload_off':
-              'off',
-          'value_template':
-              f"{{% if {i} in value_json['alarmed zones'] %}}on{{% else %}}off{{% endif %}}"
-      }
-      _mqtt_client.publish(_mqtt_topics['discovery'].format(f'binary_sensor/open_zone_{i}'),
-                           payload=to_json(open_zones_config),
-                           retain=True)
-      _mqtt_client.publish(_mqtt_topics['discovery'].format(f'binary_sensor/alarmed_zone_{i}'),
-                           payload=to_json(alarmed_zones_config),
-                           retain=True)
+    payloads.append((_mqtt_topics['discovery'].format(f'binary_sensor/open_zone_{i}'),
+                     to_json(open_zones_config)))
+    payloads.append((_mqtt_topics['discovery'].format(f'binary_sensor/alarmed_zone_{i}'),
+                     to_json(alarmed_zones_config)))
+  return tuple(payloads)
+
+
+def mqtt_publish_discovery() -> None:
+  if _mqtt_client:
+    for topic, payload in mqtt_discovery_payloads():
+      _mqtt_client.publish(topic, payload=payload, qos=0, retain=True)
 
 
 def mqtt_publish_lwt_online() -> None:
   if _mqtt_client:
     logging.debug('Publishing online to LWT')
-    _mqtt_client.publish(_mqtt_topics['lwt'], payload='online', retain=True)
+    _mqtt_client.publish(_mqtt_topics['lwt'], payload='online', qos=0, retain=True)
+
+
+_MQTT_MIN_RETRY_DELAY = 1.0
+_MQTT_MAX_RETRY_DELAY = 60.0
 
 
 def mqtt_connect() -> None:
@@ -377,26 +570,25 @@ def mqtt_connect() -> None:
 
   _mqtt_client.will_set(_mqtt_topics['lwt'], payload='offline', retain=True)
 
+  delay = _MQTT_MIN_RETRY_DELAY
   while True:
     try:
       _mqtt_client.connect(_parsed_args.mqtt_host, _parsed_args.mqtt_port)
     except (socket.timeout, OSError):
-      logging.exception('Failed to connect to MQTT broker. Retrying in 5 seconds...')
-      time.sleep(5)
+      # Jitter the retries, so that clients do not reconnect in lockstep after a broker restart.
+      retry_in = delay + random.uniform(0, delay / 2)
+      logging.exception('Failed to connect to MQTT broker. Retrying in %.1f seconds...', retry_in)
+      time.sleep(retry_in)
+      delay = min(delay * 2, _MQTT_MAX_RETRY_DELAY)
     else:
       break
 
 
-class LoginCodes(object):
-  """'Container' for all valid login codes."""
-
-  def __contains__(self, value) -> bool:
-    if not isinstance(value, str):
-      return False
-    return bool(re.fullmatch(r'\d{4,6}', value))
-
-  def __iter__(self):
-    yield '000000'
+def LoginCode(value: str) -> str:
+  """Validates a login code argument."""
+  if not (4 <= len(value) <= 6 and value.isdecimal()):
+    raise argparse.ArgumentTypeError('login code must be 4 to 6 digits')
+  return value
 
 
 def ParseArguments() -> argparse.Namespace:
@@ -410,7 +602,7 @@ def ParseArguments() -> argparse.Namespace:
   arg_parser.add_argument('-l',
                           '--login',
                           required=True,
-                          choices=LoginCodes(),
+                          type=LoginCode,
                           help='Login code to the PIMA alarm.')
   arg_parser.add_argument('-z',
                           '--zones',
@@ -429,11 +621,20 @@ def ParseArguments() -> argparse.Namespace:
                           type=int,
                           default=None,
                           help='Pima alarm port. if connected by ethernet.')
+  arg_parser.add_argument('--pacing_delay',
+                          type=float,
+                          default=1.0,
+                          help='Seconds to let the alarm process a command before the next one.')
   arg_parser.add_argument('--mqtt_host', default=None, help='MQTT broker hostname or IP address.')
   arg_parser.add_argument('--mqtt_port', type=int, default=1883, help='MQTT broker port.')
   arg_parser.add_argument('--mqtt_client_id', default=None, help='MQTT client ID.')
   arg_parser.add_argument('--mqtt_user', default=None, help='<user:password> for the MQTT channel.')
   arg_parser.add_argument('--mqtt_topic', default='pima_alarm', help='MQTT topic.')
+  arg_parser.add_argument('--mqtt_qos',
+                          default=0,
+                          type=int,
+                          choices={0, 1, 2},
+                          help='MQTT QoS level for status updates.')
   arg_parser.add_argument('--mqtt_discovery_prefix',
                           default='homeassistant',
                           help='MQTT discovery prefix for HomeAssistant.')
@@ -451,6 +652,7 @@ def ParseArguments() -> argparse.Namespace:
 
 if __name__ == '__main__':
   _parsed_args = ParseArguments()  # type: argparse.Namespace
+  _key_bytes = _parsed_args.key.encode('utf-8')  # type: bytes
 
   if os.environ.get('PLATFORM') == 'docker':
     logging_handler = logging.StreamHandler(sys.stderr)
@@ -470,36 +672,51 @@ if __name__ == '__main__':
                         '{filename}:{lineno}] {message}',
                         datefmt='%m%d %H:%M:%S',
                         style='{'))
+  # Hand records to a listener thread, so writing to syslog doesn't block polling or requests.
+  logging_queue = queue.SimpleQueue()  # type: queue.SimpleQueue
+  logging_listener = logging.handlers.QueueListener(logging_queue,
+                                                    logging_handler,
+                                                    respect_handler_level=True)
+  logging_listener.start()
+  # Flush the queued records on any exit, including sys.exit() on startup failures.
+  atexit.register(logging_listener.stop)
   logger = logging.getLogger()
   logger.setLevel(_parsed_args.log_level)
-  logger.addHandler(logging_handler)
+  logger.addHandler(logging.handlers.QueueHandler(logging_queue))
 
+  # Set before creating the server, which publishes its first status.
+  _mqtt_client = None  # type: typing.Optional[mqtt.Client]
+  _mqtt_topics = {}  # type: typing.Dict[str, str]
   _pima_server = AlarmServer()  # type: AlarmServer
   _pima_server.start()
 
-  _mqtt_client = None  # type: typing.Optional[mqtt.Client]
-  _mqtt_topics = {}  # type: typing.Dict[str, str]
   if _parsed_args.mqtt_host:
-    _mqtt_topics['pub'] = os.path.join(_parsed_args.mqtt_topic, 'status')
-    _mqtt_topics['sub'] = os.path.join(_parsed_args.mqtt_topic, 'command')
-    _mqtt_topics['lwt'] = os.path.join(_parsed_args.mqtt_topic, 'LWT')
-    _mqtt_topics['discovery'] = os.path.join(_parsed_args.mqtt_discovery_prefix, '{}', 'pima_alarm',
-                                             'config')
+    # MQTT topics always use '/', unlike os.path.join on Windows.
+    mqtt_topic = _parsed_args.mqtt_topic.rstrip('/')
+    _mqtt_topics['pub'] = mqtt_topic + '/status'
+    _mqtt_topics['sub'] = mqtt_topic + '/command'
+    _mqtt_topics['lwt'] = mqtt_topic + '/LWT'
+    _mqtt_topics['discovery'] = (_parsed_args.mqtt_discovery_prefix.rstrip('/') +
+                                 '/{}/pima_alarm/config')
     _mqtt_client = mqtt.Client(client_id=_parsed_args.mqtt_client_id, clean_session=True)
+    # Bound the messages paho keeps for the broker, instead of letting them grow without limit.
+    _mqtt_client.max_inflight_messages_set(20)
+    _mqtt_client.max_queued_messages_set(100)
     _mqtt_client.on_connect = mqtt_on_connect
     _mqtt_client.on_message = mqtt_on_message
     _mqtt_client.on_disconnect = mqtt_on_disconnect
     if _parsed_args.mqtt_user:
       _mqtt_client.username_pw_set(*_parsed_args.mqtt_user.split(':', 1))
+    threading.Thread(target=mqtt_process_commands, name='MQTTCommands', daemon=True).start()
     mqtt_connect()
     _mqtt_client.loop_start()
 
-  httpd = HTTPServer(('', _parsed_args.port), HTTPRequestHandler)
+  httpd = ThreadingHTTPServer(('', _parsed_args.port), HTTPRequestHandler)
   if _parsed_args.ssl_cert:
-    httpd.socket = ssl.wrap_socket(httpd.socket,
-                                   certfile=_parsed_args.ssl_cert,
-                                   keyfile=_parsed_args.ssl_key,
-                                   server_side=True)
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+    ssl_context.load_cert_chain(_parsed_args.ssl_cert, _parsed_args.ssl_key)
+    httpd.socket = ssl_context.wrap_socket(httpd.socket, server_side=True)
   try:
     httpd.serve_forever()
   except KeyboardInterrupt:
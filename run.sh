@@ -2,7 +2,7 @@
 set -e
 
 ARGS=
-for ARG in port key login zones mqtt_discovery_max_zone serialport pima_host pima_port mqtt_host mqtt_port mqtt_client_id mqtt_topic; do
+for ARG in port key login zones mqtt_discovery_max_zone serialport pima_host pima_port mqtt_host mqtt_port mqtt_client_id mqtt_topic mqtt_qos pacing_delay; do
   VAL=$(jq -r ".$ARG // \"\"" $OPTIONS_FILE)
   if [ -n "$VAL" ]; then
     ARGS="$ARGS --$ARG $VAL"
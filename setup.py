@@ -18,6 +18,7 @@ setuptools.setup(
     license='GPL 3.0',
     packages=setuptools.find_packages(),
     install_requires=['crcmod', 'paho-mqtt==1.6.1', 'pyserial'],
+    extras_require={'orjson': ['orjson']},
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)',